@@ -1,3 +1,4 @@
+from ._version import __version__
 from .connection import *
 from .player import *
 from .errors import *
@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import json
 import logging
 import time
@@ -8,120 +9,293 @@ import aiohttp
 import websockets
 from discord.ext import commands
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from .errors import Disconnected
 from .player import Player
 
 logger = logging.getLogger('pylava')
 logger.addHandler(logging.NullHandler())
 
+if orjson is not None:
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()  # Lavalink only handles text frames
+    _loads = orjson.loads
+else:
+    _dumps = functools.partial(json.dumps, separators=(',', ':'))  # compact, like orjson's output
+    _loads = json.loads
+
+# voice state updates (op 4) only ever differ by their IDs, so they're formatted directly instead of encoded
+# (guild IDs are passed in already stringified, see Player._guild_str)
+_VOICE_CONNECT_TEMPLATE = '{"op":4,"d":{"self_deaf":false,"guild_id":"%s","channel_id":"%s","self_mute":false}}'
+_VOICE_DISCONNECT_TEMPLATE = '{"op":4,"d":{"self_deaf":false,"guild_id":"%s","channel_id":null,"self_mute":false}}'
+
+# same goes for Lavalink's fixed-shape player ops
+_PLAY_TEMPLATE = '{"op":"play","guildId":"%s","track":%s,"startTime":%d}'
+_PLAY_UNTIL_TEMPLATE = '{"op":"play","guildId":"%s","track":%s,"startTime":%d,"endTime":%d}'
+_PAUSE_TEMPLATE = '{"op":"pause","guildId":"%s","pause":%s}'
+_STOP_TEMPLATE = '{"op":"stop","guildId":"%s"}'
+_VOLUME_TEMPLATE = '{"op":"volume","guildId":"%s","volume":%d}'
+_SEEK_TEMPLATE = '{"op":"seek","guildId":"%s","position":%d}'
+
+_eager_task_factory = getattr(asyncio, 'eager_task_factory', None)  # Python 3.12+
+
 
 class Connection:
+    _MAX_BATCH = 64  # upper bound on payloads written per writer wakeup
+
     def __init__(self, bot: Union[commands.Bot, commands.AutoShardedBot],
                  password: str, ws_url: str, rest_url: str):
         bot.add_listener(self._handler, 'on_socket_response')
+        for event in ('on_connect', 'on_disconnect', 'on_ready', 'on_resumed',
+                      'on_shard_ready', 'on_shard_disconnect', 'on_shard_resumed'):
+            bot.add_listener(self._shard_state_handler, event)
 
         self.bot = bot
         self._loop = bot.loop
         self._autosharded = isinstance(self.bot, commands.AutoShardedBot)
+        # pick the websocket lookup once, the bot's sharding mode can't change after construction
+        # on_ready / on_resumed don't say which shard they're for, so they're only trustworthy with a single shard
+        if self._autosharded:
+            self._get_discord_ws = self._get_autosharded_ws
+            ready_events = ('on_shard_ready', 'on_shard_resumed')
+        else:
+            self._get_discord_ws = self._get_single_shard_ws
+            ready_events = ('on_ready', 'on_resumed')
+        for event in ready_events:
+            bot.add_listener(self._shard_ready_handler, event)
         self._shard_count = self.bot.shard_count if self.bot.shard_count is not None else 1
         self._auth = password
         self._url = ws_url
         self._rest_url = rest_url
         self._websocket = None
+        self._http = None
+        self._ready = asyncio.Event()
+        self._outbox = None
+        self._writer = None
+        self._reconnect_task = None
+        self._shard_state_changed = asyncio.Event()
 
         self._loop.create_task(self.connect())
 
         self._players = {}
-        self._downed_shards = {}
+        self._shards_to_players = {}  # shard ID -> set of connected players
+        self._downed_shards = set()
+        self._shard_ready_events = {}
 
         self.stats = {}
 
+    @staticmethod
+    def install_uvloop() -> bool:
+        """
+        Sets uvloop's event loop policy, if uvloop is available.
+
+        This only affects event loops created afterwards, so it has to be called before the bot is constructed.
+
+        :return: Whether the uvloop policy was installed.
+        """
+        if uvloop is None:
+            return False
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return True
+
     async def _handler(self, data):
+        # runs for every gateway event, so bail on anything that isn't a voice **SERVER**!!!!!! update! NOT STATE
+        if not data or data.get('t') != 'VOICE_SERVER_UPDATE':
+            return
         if not self.connected:
             return
 
-        if not data:
-            return
-        if data['op'] != 0:
+        event = data['d']
+        guild_id = int(event['guild_id'])
+        player = self.get_player(guild_id)
+        if not player._connecting:
             return
+        player._connecting = False
 
-        if data['t'] == 'VOICE_SERVER_UPDATE':  # voice **SERVER**!!!!!! update! NOT STATE
-            player = self.get_player(int(data['d']['guild_id']))
-            if not player._connecting:
-                return
-            else:
-                player._connecting = False
-
-            payload = {
-                'op': 'voiceUpdate',
-                'guildId': data['d']['guild_id'],
-                'sessionId': self.bot.get_guild(int(data['d']['guild_id'])).me.voice.session_id,
-                'event': data['d']
-            }
-            await self._send(**payload)
-
-    async def _discord_connection_state_loop(self):
-        while self.connected:
-            shard_guild_map = {}
-            for guild in self._players:
-                if not self._players[guild].connected:
-                    continue
-
-                guild_shard_id = (guild >> 22) % self._shard_count
-
-                if guild_shard_id not in shard_guild_map:
-                    shard_guild_map[guild_shard_id] = []
-                shard_guild_map[guild_shard_id].append(guild)
-
-            for shard, guilds in shard_guild_map.items():
+        await self._send(_dumps({
+            'op': 'voiceUpdate',
+            'guildId': event['guild_id'],
+            'sessionId': self.bot.get_guild(guild_id).me.voice.session_id,
+            'event': event
+        }))
+
+    async def _shard_state_handler(self, *_):
+        self._shard_state_changed.set()
+
+    async def _shard_ready_handler(self, shard_id=None):
+        if shard_id is None:  # on_ready / on_resumed, only listened to when there's just the one shard
+            events = self._shard_ready_events.values()
+        else:
+            events = (self._shard_ready_events.setdefault(shard_id, asyncio.Event()),)
+        for event in events:
+            event.set()
+
+    async def _discord_connection_state_loop(self, websocket):
+        while websocket.open:  # a fresh loop gets started on every connect()
+            for shard, players in self._shards_to_players.items():
                 ws = self._get_discord_ws(shard)
                 if not ws or not ws.open:
-                    self._downed_shards[shard] = True
-                    logger.debug('Shard {} detected as offline, handling...'.format(shard))
-                    continue
-
-                if self._downed_shards.get(shard):
-                    self._downed_shards.pop(shard)
-                    self._loop.create_task(self._discord_reconnect_task(guilds))
+                    if shard not in self._downed_shards:
+                        self._downed_shards.add(shard)
+                        self._shard_ready_events.setdefault(shard, asyncio.Event()).clear()
+                        logger.debug('Shard {} detected as offline, handling...'.format(shard))
+                elif shard in self._downed_shards:
+                    self._downed_shards.remove(shard)
+                    self._loop.create_task(self._discord_reconnect_task(shard, tuple(players)))
                     logger.debug('Shard {} detected as online again, reconnecting guilds...'.format(shard))
 
-            await asyncio.sleep(0.1)
-
-    async def _discord_reconnect_task(self, guilds):
-        await asyncio.sleep(10)  # fixed wait for READY / RESUMED
-        for guild in guilds:
-            await self._players[guild].connect(self._players[guild]._channel)
+            try:
+                # woken by gateway events, with a periodic check in case an event goes missing
+                await asyncio.wait_for(self._shard_state_changed.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+            self._shard_state_changed.clear()
+
+    async def _discord_reconnect_task(self, shard_id, players):
+        try:
+            # wait for READY / RESUMED, but don't hold the guilds hostage should we miss it
+            await asyncio.wait_for(self._shard_ready_events[shard_id].wait(), 10)
+        except asyncio.TimeoutError:
+            pass
+        for player in players:
+            if not self.connected or player._channel is None:
+                continue  # we've disconnected from Lavalink or the player left in the meantime
+            await player.connect(player._channel)
             await asyncio.sleep(1)  # 1 connection / second (gateway ratelimits = bad)
 
-    async def _lava_event_processor(self):
-        while self.connected:
-            try:
-                data = json.loads(await self._websocket.recv())
-            except (websockets.ConnectionClosed, AttributeError):
-                return  # oh well
+    def _lava_stats(self, data):
+        data.pop('op')
+        self.stats = data
 
-            logger.debug('Received a payload from Lavalink: {}'.format(data))
-            op = data.get('op')
+    def _lava_player_update(self, data):
+        state = data['state']
+        if 'position' not in state:
+            return
+        player = self.get_player(int(data['guildId']))
 
-            if op == 'stats':
-                data.pop('op')
-                self.stats = data
+        # position plus however long the update took to reach us, all in milliseconds until the end
+        now = time.time() * 1000
+        player._position = (state['position'] + now - state['time']) / 1000
 
-            if op == 'playerUpdate' and 'position' in data['state']:
-                player = self.get_player(int(data['guildId']))
+    def _lava_event(self, data):
+        player = self.get_player(int(data['guildId']))
+        self._create_eager_task(player._process_event(data))
 
-                lag = time.time() - data['state']['time'] / 1000
-                player._position = data['state']['position'] / 1000 + lag
-            if op == 'event':
-                player = self.get_player(int(data['guildId']))
-                self._loop.create_task(player._process_event(data))
+    _OP_HANDLERS = {
+        'stats': _lava_stats,
+        'playerUpdate': _lava_player_update,
+        'event': _lava_event,
+    }
 
-    def _get_discord_ws(self, shard_id):
-        if self._autosharded:
-            return self.bot.shards[shard_id].ws
-        if self.bot.shard_id is None or self.bot.shard_id == shard_id:
+    async def _lava_event_processor(self, websocket):
+        recv = websocket.recv  # this task lives and dies with this websocket
+        while websocket.open:
+            try:
+                raw = await recv()
+            except (websockets.ConnectionClosed, AttributeError):
+                break
+
+            # a malformed frame must not kill the reader either
+            try:
+                data = _loads(raw)
+            except ValueError:
+                logger.warning('Received a malformed payload from Lavalink: {}'.format(raw))
+                continue
+            if not isinstance(data, dict):
+                logger.warning('Received an unexpected payload from Lavalink: {}'.format(raw))
+                continue
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Received a payload from Lavalink: {}'.format(data))
+
+            handler = self._OP_HANDLERS.get(data.get('op'))
+            if handler is None:
+                continue
+            try:
+                handler(self, data)
+            except Exception:
+                # a single bad payload must not kill the reader while the websocket stays open
+                logger.exception('Failed to process a payload from Lavalink: {}'.format(data))
+
+        if self._websocket is websocket:  # disconnect() wasn't called, so the connection was lost
+            self._ready.clear()
+            self._shard_state_changed.set()
+            # Lavalink destroys its players along with the connection, so leave their voice channels as well,
+            # otherwise reconnecting to the same channel might never get us a fresh VOICE_SERVER_UPDATE
+            connected = [player for players in self._shards_to_players.values() for player in players]
+            self._loop.create_task(self._discord_leave_voice(connected))
+            self._reset_players()
+            logger.warning('Lost the connection to Lavalink, reconnecting...')
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+
+    async def _discord_leave_voice(self, players):
+        for player in players:
+            current = self._players.get(player._guild)
+            if current is not None and current.connected:
+                continue  # someone connected this guild again in the meantime, leave it be
+            try:
+                await self._discord_disconnect(player._shard_id, player._guild_str)
+            except Exception:
+                # most likely the shard is down as well, nothing more we can do for this guild then
+                logger.warning('Failed to leave voice in guild {}.'.format(player._guild))
+                continue
+            await asyncio.sleep(1)  # 1 disconnect / second (gateway ratelimits = bad)
+
+    async def _reconnect(self):
+        delay = 1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+            except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake):
+                delay = min(delay * 2, 60)
+                logger.warning('Reconnecting to Lavalink failed, retrying in {} seconds.'.format(delay))
+            else:
+                self._reconnect_task = None
+                return
+
+    async def _writer_loop(self, websocket, outbox: asyncio.Queue):
+        send = websocket.send  # bound once, this task lives and dies with this websocket
+        while True:
+            batch = [await outbox.get()]
+            # drain everything queued in the meantime so a burst goes out back to back
+            while len(batch) < self._MAX_BATCH and not outbox.empty():
+                batch.append(outbox.get_nowait())
+
+            for payload in batch:
+                if payload is None:
+                    return  # disconnect() asked us to stop, everything queued before that has been sent
+                try:
+                    await send(payload)
+                except websockets.ConnectionClosed:
+                    return  # connection's gone, the next connect() starts a fresh writer
+                except Exception:
+                    # same as the reader, a single failed send must not silently stall everything queued after it
+                    logger.exception('Failed to send a payload to Lavalink: {}'.format(payload))
+
+    def _create_eager_task(self, coro):
+        # runs the coroutine inline up to its first suspension, so handlers that return early are never scheduled
+        if _eager_task_factory is not None:
+            return _eager_task_factory(self._loop, coro)
+        return self._loop.create_task(coro)
+
+    def _get_autosharded_ws(self, shard_id):
+        return self.bot.shards[shard_id].ws
+
+    def _get_single_shard_ws(self, shard_id):
+        bot = self.bot
+        if bot.shard_id is None or bot.shard_id == shard_id:
             # only return if the shard actually matches the current shard, useful for ignoring events not meant for us
-            return self.bot.ws
+            return bot.ws
 
     async def connect(self):
         """Connects to Lavalink. Gets automatically called once when the Connection object is created."""
@@ -132,8 +306,13 @@ class Connection:
             'User-Id': self.bot.user.id
         }
         self._websocket = await websockets.connect(self._url, extra_headers=headers)
-        self._loop.create_task(self._lava_event_processor())
-        self._loop.create_task(self._discord_connection_state_loop())
+        if self._writer is not None:
+            self._writer.cancel()
+        self._outbox = asyncio.Queue()
+        self._writer = self._loop.create_task(self._writer_loop(self._websocket, self._outbox))
+        self._ready.set()
+        self._loop.create_task(self._lava_event_processor(self._websocket))
+        self._loop.create_task(self._discord_connection_state_loop(self._websocket))
         logger.info('Successfully connected to Lavalink.')
 
     async def query(self, query: str, *, retry_count=0, retry_delay=0) -> list:
@@ -144,26 +323,28 @@ class Connection:
         :param retry_count: How often to retry the query should it fail. 0 disables, -1 will try forever (dangerous).
         :param retry_delay: How long to sleep for between retries.
         """
-        headers = {
-            'Authorization': self._auth,
-            'Accept': 'application/json'
-        }
+        if self._http is None or self._http.closed:
+            # created on first use and then shared, so queries reuse pooled keep-alive connections
+            self._http = aiohttp.ClientSession(
+                headers={'Authorization': self._auth, 'Accept': 'application/json'},
+                connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+            )
+
         params = {
             'identifier': query
         }
-        async with aiohttp.ClientSession(headers=headers) as s:
-            while True:
-                async with s.get(self._rest_url+'/loadtracks', params=params) as resp:
-                    out = await resp.json()
-
-                # -1 is not recommended unless you run it as a task which you cancel after a specific time, but
-                # you do you devs
-                if not out and (retry_count > 0 or retry_count < 0):  # edge case where lavalink just returns nothing
-                    retry_count -= 1
-                    if retry_delay:
-                        await asyncio.sleep(retry_delay)
-                else:
-                    break
+        while True:
+            async with self._http.get(self._rest_url+'/loadtracks', params=params) as resp:
+                out = await resp.json(loads=_loads)
+
+            # -1 is not recommended unless you run it as a task which you cancel after a specific time, but
+            # you do you devs
+            if not out and (retry_count > 0 or retry_count < 0):  # edge case where lavalink just returns nothing
+                retry_count -= 1
+                if retry_delay:
+                    await asyncio.sleep(retry_delay)
+            else:
+                break
         return out
 
     @property
@@ -176,76 +357,87 @@ class Connection:
 
     async def disconnect(self):
         """Disconnects from Lavalink."""
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
         if not self.connected:
             raise Disconnected()
-        await self._websocket.close()
-        self._websocket = None
-        self._players = {}  # this is why you shouldn't hold references to players for too long
+        websocket, self._websocket = self._websocket, None  # unset first so the reader knows this was on purpose
+        if self._writer is not None:
+            # flush whatever's still queued (e.g. a stop() right before this) before closing
+            self._outbox.put_nowait(None)
+            await self._writer
+            self._writer = None
+        await websocket.close()
+        self._ready.clear()
+        self._shard_state_changed.set()  # let the shard state loop notice and exit
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        self._reset_players()
         logger.info('Disconnected from Lavalink and reset state.')
 
     async def wait_until_ready(self):
         """Waits indefinitely until the Lavalink connection has been established."""
-        while not self.connected:
-            await asyncio.sleep(0.01)
+        await self._ready.wait()
 
-    async def _send(self, **data):
+    async def _send(self, payload: str):
         if not self.connected:
             logger.debug('Refusing to send a payload to Lavalink due to websocket disconnection.')
             raise Disconnected()  # refuse to send anything
 
-        if isinstance(data, dict):
-            if isinstance(data.get('guildId'), int):
-                data['guildId'] = str(data['guildId'])
-            if isinstance(data.get('channelId'), int):
-                data['channelId'] = str(data['channelId'])
-        logger.debug('Sending a payload to Lavalink: {}'.format(data))
-        await self._websocket.send(json.dumps(data))
-
-    async def _discord_disconnect(self, guild_id: int):
-        shard_id = (guild_id >> 22) % self._shard_count
-        await self._get_discord_ws(shard_id).send(json.dumps({
-            'op': 4,
-            'd': {
-                'self_deaf': False,
-                'guild_id': str(guild_id),
-                'channel_id': None,
-                'self_mute': False
-            }
-        }))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Sending a payload to Lavalink: {}'.format(payload))
+        self._outbox.put_nowait(payload)  # unbounded, so this never has to wait
 
-    async def _discord_connect(self, guild_id: int, channel_id: int):
-        shard_id = (guild_id >> 22) % self._shard_count
-        await self._get_discord_ws(shard_id).send(json.dumps({
-            'op': 4,
-            'd': {
-                'self_deaf': False,
-                'guild_id': str(guild_id),
-                'channel_id': str(channel_id),
-                'self_mute': False
-            }
-        }))
+    async def _discord_disconnect(self, shard_id: int, guild_id: str):
+        await self._get_discord_ws(shard_id).send(_VOICE_DISCONNECT_TEMPLATE % guild_id)
+
+    async def _discord_connect(self, shard_id: int, guild_id: str, channel_id: int):
+        await self._get_discord_ws(shard_id).send(_VOICE_CONNECT_TEMPLATE % (guild_id, channel_id))
 
-    async def _discord_play(self, guild_id: int, track: str, start_time: float, end_time: Optional[float]):
+    async def _discord_play(self, guild_id: str, track: str, start_time: float, end_time: Optional[float]):
         if end_time is not None:
-            await self._send(op='play', guildId=guild_id, track=track,
-                             startTime=int(start_time*1000), endTime=int(end_time*1000))
+            await self._send(_PLAY_UNTIL_TEMPLATE % (guild_id, _dumps(track), start_time*1000, end_time*1000))
         else:
-            await self._send(op='play', guildId=guild_id, track=track, startTime=int(start_time*1000))
+            await self._send(_PLAY_TEMPLATE % (guild_id, _dumps(track), start_time*1000))
 
-    async def _discord_pause(self, guild_id: int, paused: bool):
-        await self._send(op='pause', guildId=guild_id, pause=paused)
+    async def _discord_pause(self, guild_id: str, paused: bool):
+        await self._send(_PAUSE_TEMPLATE % (guild_id, 'true' if paused else 'false'))
 
-    async def _discord_stop(self, guild_id: int):
-        await self._send(op='stop', guildId=guild_id)
+    async def _discord_stop(self, guild_id: str):
+        await self._send(_STOP_TEMPLATE % guild_id)
 
-    async def _discord_volume(self, guild_id: int, level: int):
+    async def _discord_volume(self, guild_id: str, level: int):
         level = max(min(level, 150), 0)
-        await self._send(op='volume', guildId=guild_id, volume=level)
+        await self._send(_VOLUME_TEMPLATE % (guild_id, level))
         return level
 
-    async def _discord_seek(self, guild_id: int, position: float):
-        position = int(position * 1000)
-        await self._send(op='seek', guildId=guild_id, position=position)
+    async def _discord_seek(self, guild_id: str, position: float):
+        await self._send(_SEEK_TEMPLATE % (guild_id, position * 1000))
+
+    def _reset_players(self):
+        for player in self._players.values():
+            # anyone still holding on to one shouldn't see it as connected or playing anymore
+            player._connecting = False
+            player._channel = None
+            player._paused = False
+            player._playing = False
+            player._position = None
+        self._players.clear()  # this is why you shouldn't hold references to players for too long
+        self._shards_to_players.clear()
+        self._downed_shards.clear()
+
+    def _register_player(self, player: Player):
+        self._shards_to_players.setdefault(player._shard_id, set()).add(player)
+
+    def _unregister_player(self, player: Player):
+        players = self._shards_to_players.get(player._shard_id)
+        if players is None:
+            return
+        players.discard(player)
+        if not players:
+            self._shards_to_players.pop(player._shard_id)
 
     def get_player(self, guild_id: int) -> Player:
         """
@@ -1,4 +1,4 @@
-from inspect import isawaitable, signature
+from inspect import isawaitable, iscoroutinefunction, signature
 from typing import Optional, Callable
 
 from discord import VoiceChannel, Guild
@@ -7,12 +7,15 @@ from discord import VoiceChannel, Guild
 # noinspection PyProtectedMember
 class Player:
     __slots__ = [
-        'conn', '_guild', '_channel', '_paused', '_playing', '_position', '_volume', '_track_callback', '_connecting'
+        'conn', '_guild', '_guild_str', '_shard_id', '_channel', '_paused', '_playing', '_position', '_volume',
+        '_track_callback', '_track_callback_params', '_track_callback_is_coro', '_connecting'
     ]
 
     def __init__(self, connection, guild_id: int):
         self.conn = connection
         self._guild = guild_id
+        self._guild_str = str(guild_id)  # Lavalink and the gateway want IDs as strings
+        self._shard_id = (guild_id >> 22) % connection._shard_count
         self._connecting = False
         # dynamic variables:
         self._channel = None
@@ -21,6 +24,8 @@ class Player:
         self._position = None
         self._volume = 100
         self._track_callback = None
+        self._track_callback_params = {}
+        self._track_callback_is_coro = False
 
     @property
     def channel(self) -> Optional[VoiceChannel]:
@@ -78,17 +83,22 @@ class Player:
     @track_callback.setter
     def track_callback(self, c: Optional[Callable]):
         self._track_callback = c
+        # inspect the callback once here instead of on every track end
+        self._track_callback_params = signature(c).parameters if c is not None else {}
+        self._track_callback_is_coro = iscoroutinefunction(c)
 
     async def connect(self, channel_id: int):
         """Connects the player to a Discord channel."""
         self._connecting = True
-        await self.conn._discord_connect(self._guild, channel_id)
+        await self.conn._discord_connect(self._shard_id, self._guild_str, channel_id)
         self._channel = channel_id
+        self.conn._register_player(self)
 
     async def disconnect(self):
         """Disconnects the player from Discord."""
-        await self.conn._discord_disconnect(self._guild)
+        await self.conn._discord_disconnect(self._shard_id, self._guild_str)
         self._channel = None
+        self.conn._unregister_player(self)
 
     async def query(self, *args, **kwargs):
         """Shortcut method for :meth:`Connection.query`."""
@@ -102,14 +112,14 @@ class Player:
         :param start_time: (optional) How far into the track to start playing (defaults to 0).
         :param end_time: (optional) At what point in the track to stop playing (defaults to track length).
         """
-        await self.conn._discord_play(self._guild, track, start_time, end_time)
+        await self.conn._discord_play(self._guild_str, track, start_time, end_time)
         self._playing = True
 
     async def set_pause(self, paused: bool):
         """Sets the pause state."""
         if paused == self._paused:
             return  # state's already set
-        await self.conn._discord_pause(self._guild, paused)
+        await self.conn._discord_pause(self._guild_str, paused)
         self._paused = paused
 
     async def set_volume(self, volume: int):
@@ -118,16 +128,16 @@ class Player:
 
         :param volume: An integer between (and including) 0 and 150.
         """
-        self._volume = await self.conn._discord_volume(self._guild, volume)
+        self._volume = await self.conn._discord_volume(self._guild_str, volume)
 
     async def stop(self):
         """Stops the player."""
-        await self.conn._discord_stop(self._guild)
+        await self.conn._discord_stop(self._guild_str)
         self._playing = False
 
     async def seek(self, position: float):
         """Seeks to a specific position in a track."""
-        await self.conn._discord_seek(self._guild, position)
+        await self.conn._discord_seek(self._guild_str, position)
 
     async def _process_event(self, data):
         if data['op'] != 'event':
@@ -141,13 +151,11 @@ class Player:
                 return
 
             kwargs = {}
-            sig = signature(self.track_callback)
-            if sig:
-                if 'player' in sig.parameters:
-                    kwargs['player'] = self
-                if 'reason' in sig.parameters:
-                    kwargs['reason'] = data.get('reason')
-
-            out = self.track_callback(**kwargs)
-            if isawaitable(out):
+            if 'player' in self._track_callback_params:
+                kwargs['player'] = self
+            if 'reason' in self._track_callback_params:
+                kwargs['reason'] = data.get('reason')
+
+            out = self._track_callback(**kwargs)
+            if self._track_callback_is_coro or isawaitable(out):
                 await out
@@ -1,18 +1,19 @@
+import ast
+import os
+
 from setuptools import setup
 
 
-requires = [line for line in open('requirements.txt').read().strip().split('\n') if not line.startswith('http')]
+with open('requirements.txt') as f:
+    requires = [line for line in f.read().splitlines() if line and not line.startswith('http')]
 
-version = '0.0.1'
-# noinspection PyBroadException
-try:
-    import subprocess
-    p = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    commit, _ = p.communicate()
-    if commit:
-        version += '+git.' + commit.decode('UTF-8').strip()
-except Exception:
-    pass
+version = '0.0.1+dev'
+# read rather than imported, importing pylava would pull in discord.py before it's installed
+if os.path.exists('pylava/_version.py'):
+    with open('pylava/_version.py') as f:
+        for line in f:
+            if line.startswith('__version__ = '):
+                version = ast.literal_eval(line.split('=', 1)[1].strip())
 
 setup(
     name='pylava',
@@ -21,5 +22,8 @@ setup(
     license='MIT',
     packages=['pylava'],
     install_requires=requires,
+    extras_require={
+        'speedups': ['orjson', 'uvloop; sys_platform != "win32"'],
+    },
     version=version,
 )